@@ -49,9 +49,10 @@ class Datastore:
         type: str,
         client: str,
         hostname: str,
-        created: datetime = datetime.now(timezone.utc),
+        created: Optional[datetime] = None,
         name: Optional[str] = None,
     ) -> "Bucket":
+        created = created or datetime.now(timezone.utc)
         self.logger.info(f"Creating bucket '{bucket_id}'")
         self.storage_strategy.create_bucket(
             bucket_id, type, client, hostname, created.isoformat(), name=name
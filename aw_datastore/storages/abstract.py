@@ -1,6 +1,6 @@
 import logging
 from typing import List, Dict, Optional
-from datetime import datetime
+from datetime import date, datetime
 from abc import ABCMeta, abstractmethod, abstractproperty
 
 from aw_core.models import Event
@@ -60,6 +60,10 @@ class AbstractStorage(metaclass=ABCMeta):
     ) -> List[Event]:
         raise NotImplementedError
 
+    def get_last_event(self, bucket_id: str, day: Optional[date] = None) -> List[Event]:
+        """Returns the last event of the given day as a list of at most one event"""
+        raise NotImplementedError
+
     def get_eventcount(
         self,
         bucket_id: str,
@@ -101,7 +105,7 @@ class AbstractStorage(metaclass=ABCMeta):
         raise NotImplementedError
 
     @abstractmethod
-    def get_use_tracker(self):
+    def get_use_tracker(self, day: Optional[date] = None):
         raise NotImplementedError
 
     @abstractmethod
@@ -109,5 +113,5 @@ class AbstractStorage(metaclass=ABCMeta):
         raise NotImplementedError
 
     @abstractmethod
-    def get_report(self):
+    def get_report(self, email, day: Optional[date] = None):
         raise NotImplementedError
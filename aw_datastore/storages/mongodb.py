@@ -1,6 +1,6 @@
 import logging
 from typing import List, Dict, Optional
-from datetime import datetime, timezone
+from datetime import date, datetime, timezone
 import threading
 import time
 
@@ -9,6 +9,8 @@ import iso8601
 # MongoDB
 try:
     import pymongo
+    from pymongo import InsertOne, UpdateOne
+    from pymongo.write_concern import WriteConcern
     from bson import json_util
     from bson.objectid import ObjectId
 except ImportError:  # pragma: no cover
@@ -19,6 +21,25 @@ from aw_core.models import Event
 from . import logger
 from .abstract import AbstractStorage
 
+# How long buckets() may serve the cached bucket list before reloading it.
+# Changes made through this storage update the cache immediately, the TTL only
+# bounds how stale buckets created/deleted by other processes can be.
+BUCKETS_TTL_SECONDS = 6.0
+
+_client: Optional["pymongo.MongoClient"] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> "pymongo.MongoClient":
+    """Returns a MongoClient shared by all MongoDBStorage instances"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = pymongo.MongoClient(
+                "mongodb://172.16.110.8:27017/", serverSelectionTimeoutMS=5000
+            )
+        return _client
+
 
 class MongoDBStorage(AbstractStorage):
     """Uses a MongoDB server as backend"""
@@ -29,18 +50,42 @@ class MongoDBStorage(AbstractStorage):
         self.logger = logger.getChild(self.sid)
         configsection = "server" if not testing else "server-testing"
 
-        self.client = pymongo.MongoClient('mongodb://172.16.110.8:27017/',serverSelectionTimeoutMS=5000)
-        # Try to connect to the server to make sure that it's available
-        # If it isn't, it will raise pymongo.errors.ServerSelectionTimeoutError
-        self.client.server_info()
+        # pymongo connects lazily, if the server isn't available the first
+        # operation will raise pymongo.errors.ServerSelectionTimeoutError
+        self.client = _get_client()
 
         self.db = self.client["komutracker" + ("-testing" if testing else "")]
-
-        self.cached_buckets = None
-        self.last_cached_ms = 0
+        # Unacknowledged writes for bulk event ingestion, where throughput matters
+        # more than durability. Metadata and users keep the default write concern.
+        self.events_db = self.db.with_options(write_concern=WriteConcern(w=0))
+
+        # Bucket metadata is kept in a single collection so that listing buckets
+        # is one query instead of enumerating every collection in the database
+        self.buckets_coll = self.db["buckets"]
+        self.buckets_coll.create_index("id", unique=True)
+        if self.buckets_coll.estimated_document_count() == 0:
+            self._migrate_bucket_metadata()
+
+        # Metadata per bucket, kept up to date by create_bucket/delete_bucket.
+        # cached_buckets points at the same dict once all buckets have been loaded.
+        self._meta_cache: Dict[str, dict] = {}
+        self.cached_buckets: Optional[Dict[str, dict]] = None
+        self._cache_deadline = 0.0
+        self._cache_lock = threading.Lock()
         
         self.db["users"].create_index('email', unique=True)
-        #self.lock = threading.Lock()
+
+    def _migrate_bucket_metadata(self) -> None:
+        """Copies metadata from legacy per-bucket ``<bucket_id>.metadata`` collections"""
+        for coll_name in self.db.list_collection_names():
+            if not coll_name.endswith(".metadata"):
+                continue
+            metadata = self.db[coll_name].find_one({"_id": "metadata"})
+            if metadata:
+                del metadata["_id"]
+                self.buckets_coll.insert_one(metadata)
+                # Buckets created before the timestamp index existed, new ones get it in create_bucket
+                self.db[metadata["id"]]["events"].create_index([("timestamp", 1)])
 
     def create_bucket(
         self,
@@ -54,7 +99,6 @@ class MongoDBStorage(AbstractStorage):
         if not name:
             name = bucket_id
         metadata = {
-            "_id": "metadata",
             "id": bucket_id,
             "name": name,
             "type": type_id,
@@ -62,64 +106,83 @@ class MongoDBStorage(AbstractStorage):
             "hostname": hostname,
             "created": created,
         }
-        self.db[bucket_id]["metadata"].insert_one(metadata)
+        # .copy is needed because otherwise mongodb inserts a _id field into the metadata
+        self.buckets_coll.insert_one(metadata.copy())
+        self.db[bucket_id]["events"].create_index([("timestamp", 1)])
+        with self._cache_lock:
+            self._meta_cache[bucket_id] = metadata
 
     def delete_bucket(self, bucket_id: str) -> None:
-        print(self.db.list_collection_names())
-        if bucket_id + ".metadata" in self.db.list_collection_names():
+        result = self.buckets_coll.delete_one({"id": bucket_id})
+        if result.deleted_count >= 1:
             self.db[bucket_id]["events"].drop()
+            # Legacy metadata collection, only present on buckets created before the migration
             self.db[bucket_id]["metadata"].drop()
+            with self._cache_lock:
+                self._meta_cache.pop(bucket_id, None)
         else:
             # TODO: Create custom exception
             raise Exception("Bucket did not exist, could not delete")
     
     def buckets(self) -> Dict[str, dict]:
-        #self.lock.acquire()
-        
-        if time.time() - self.last_cached_ms < 6000:
-            return self.cached_buckets
-
-        bucketnames = set()
-        for bucket_coll in self.db.list_collection_names():
-            bucketnames.add(bucket_coll[:bucket_coll.rfind('.')])
-        bucketnames.discard("system")  # Discard all system collections
-        bucketnames.discard("user")
-        buckets = dict()
-        for bucket_id in bucketnames:
-            try:
-                buckets[bucket_id] = self.get_metadata(bucket_id)
-            except:
-                self.logger.error("Could not get metadata for bucket %s", bucket_id)
-        
-        self.cached_buckets = buckets
-        self.last_cached_ms = time.time()
-        
-        #self.lock.release()
-
-        return buckets
+        with self._cache_lock:
+            cached = self.cached_buckets
+            if cached is None or time.monotonic() >= self._cache_deadline:
+                cached = {
+                    d["id"]: d for d in self.buckets_coll.find({}, {"_id": 0})
+                }
+                self._meta_cache = cached
+                self.cached_buckets = cached
+                self._cache_deadline = time.monotonic() + BUCKETS_TTL_SECONDS
+            # Copies, so that callers mutating the result can't corrupt the cache
+            return {bucket_id: dict(md) for bucket_id, md in cached.items()}
 
     def get_metadata(self, bucket_id: str) -> dict:
-        metadata = self.db[bucket_id]["metadata"].find_one({"_id": "metadata"})
-        if metadata:
-            del metadata["_id"]
-            return metadata
-        else:
-            raise Exception("Bucket did not exist, could not get metadata")
-
-    def get_events(
+        # The lock is held across the lookup so a concurrent delete_bucket can't
+        # have its removal overwritten by a stale document
+        with self._cache_lock:
+            if bucket_id not in self._meta_cache:
+                metadata = self.buckets_coll.find_one({"id": bucket_id}, {"_id": 0})
+                if not metadata:
+                    raise Exception("Bucket did not exist, could not get metadata")
+                self._meta_cache[bucket_id] = metadata
+            return dict(self._meta_cache[bucket_id])
+
+    @staticmethod
+    def _as_utc(dt: datetime) -> datetime:
+        # Naive datetimes are taken to be UTC, like the timestamps stored by insert
+        if dt.tzinfo is None:
+            return dt.replace(tzinfo=timezone.utc)
+        return dt.astimezone(timezone.utc)
+
+    def _timestamp_filter(
         self,
-        bucket_id: str,
-        limit: int,
         starttime: Optional[datetime] = None,
         endtime: Optional[datetime] = None,
-    ):
+    ) -> Dict[str, dict]:
+        # The range must be given as BSON dates, a string would silently turn
+        # into a string comparison that can't use the timestamp index
         query_filter: Dict[str, dict] = {}
         if starttime or endtime:
             query_filter["timestamp"] = {}
             if starttime:
-                query_filter["timestamp"]["$gte"] = starttime
+                if isinstance(starttime, str):
+                    starttime = iso8601.parse_date(starttime)
+                query_filter["timestamp"]["$gte"] = self._as_utc(starttime)
             if endtime:
-                query_filter["timestamp"]["$lte"] = endtime
+                if isinstance(endtime, str):
+                    endtime = iso8601.parse_date(endtime)
+                query_filter["timestamp"]["$lte"] = self._as_utc(endtime)
+        return query_filter
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ):
+        query_filter = self._timestamp_filter(starttime, endtime)
 
         if limit == 0:
             return []
@@ -161,14 +224,11 @@ class MongoDBStorage(AbstractStorage):
     def get_eventcount(
         self, bucket_id: str, starttime: datetime = None, endtime: datetime = None
     ) -> int:
-        query_filter: Dict[str, dict] = {}
-        if starttime or endtime:
-            query_filter["timestamp"] = {}
-            if starttime:
-                query_filter["timestamp"]["$gte"] = starttime
-            if endtime:
-                query_filter["timestamp"]["$lte"] = endtime
-        return self.db[bucket_id]["events"].find(query_filter).count()
+        query_filter = self._timestamp_filter(starttime, endtime)
+        events_coll = self.db[bucket_id]["events"]
+        if not query_filter:
+            return events_coll.estimated_document_count()
+        return events_coll.count_documents(query_filter)
 
     def _transform_event(self, event: dict) -> dict:
         if "duration" in event:  # pragma: no cover
@@ -184,23 +244,44 @@ class MongoDBStorage(AbstractStorage):
         return event
 
     def insert_many(self, bucket: str, events: List[Event]):
-        # .copy is needed because otherwise mongodb inserts a _id field into the event
-        dict_events: List[dict] = [
-            self._transform_event(event.copy()) for event in events
-        ]
-        self.db[bucket]["events"].insert_many(dict_events)
+        # Events with an id are upserts, the rest are plain inserts.
+        # Each group is sent as a single unordered bulk_write.
+        upserts = []
+        inserts = []
+        for event in events:
+            # .copy is needed because otherwise mongodb inserts a _id field into the event
+            dict_event = self._transform_event(event.copy())
+            if event.id is not None:
+                event_id = dict_event.pop("id")
+                if ObjectId.is_valid(event_id):
+                    event_id = ObjectId(event_id)
+                upserts.append(
+                    UpdateOne({"_id": event_id}, {"$set": dict_event}, upsert=True)
+                )
+            else:
+                inserts.append(InsertOne(dict_event))
+        # Upserts modify existing events, so they're acknowledged to keep read-your-writes
+        if upserts:
+            self.db[bucket]["events"].bulk_write(upserts, ordered=False)
+        if inserts:
+            self.events_db[bucket]["events"].bulk_write(inserts, ordered=False)
 
     def delete(self, bucket_id: str, event_id) -> bool:
         result = self.db[bucket_id]["events"].delete_one({"_id": ObjectId(event_id)})
         return result.deleted_count >= 1
 
     def replace_last(self, bucket_id: str, event: Event):
-        last_event = list(
-            self.db[bucket_id]["events"].find().sort([("timestamp", -1)]).limit(1)
-        )[0]
-        self.db[bucket_id]["events"].replace_one(
-            {"_id": last_event["_id"]}, self._transform_event(event.copy())
+        # Finds and replaces the last event in one atomic round-trip, the sort is
+        # covered by the timestamp index and only the _id is sent back
+        last_event = self.db[bucket_id]["events"].find_one_and_replace(
+            {},
+            self._transform_event(event.copy()),
+            sort=[("timestamp", -1)],
+            projection={"_id": 1},
         )
+        if last_event is None:
+            # TODO: Create custom exception
+            raise Exception("Bucket is empty, could not replace last event")
 
     def replace(self, bucket_id: str, event_id, event: Event) -> bool:
         self.db[bucket_id]["events"].replace_one(
@@ -210,11 +291,12 @@ class MongoDBStorage(AbstractStorage):
         return True
 
     def save_user(self, user_data):
-        user_data["email"]
-
-        self.db["users"].delete_many({"email": user_data["email"]})
-
-        self.db["users"].insert_one(user_data)
+        result = self.db["users"].replace_one(
+            {"email": user_data["email"]}, user_data, upsert=True
+        )
+        if result.upserted_id is not None:
+            # Like insert_one did, hand back the _id of a newly created user
+            user_data["_id"] = result.upserted_id
 
         return user_data
 
@@ -224,11 +306,11 @@ class MongoDBStorage(AbstractStorage):
     def get_all_users(self):
         return self.db["users"].find()
 
-    def get_use_tracker(self, day=datetime.now().date()):
+    def get_use_tracker(self, day: Optional[date] = None):
         return None
 
     def save_report(self, report_data):
         return None
 
-    def get_report(self, email, day=datetime.now()):
+    def get_report(self, email, day: Optional[date] = None):
         return None
\ No newline at end of file
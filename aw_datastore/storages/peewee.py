@@ -1,12 +1,48 @@
 from email.policy import default
+import functools
 import time
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Callable, Union
 from datetime import date, datetime, timezone, timedelta
 import json
+import math
 import os
 import logging
 import iso8601
 
+try:
+    import orjson
+
+    json_loads: Callable[[Union[str, bytes]], Any] = orjson.loads
+
+    def json_dumps(obj) -> str:
+        try:
+            # OPT_NON_STR_KEYS matches json.dumps, which coerces int/float keys to strings
+            out = orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+        except orjson.JSONEncodeError:
+            # orjson rejects some data the stdlib accepts, such as integers over 64 bits
+            return json.dumps(obj)
+        # orjson writes NaN and Infinity as null where json.dumps keeps them,
+        # only data that serialized to a null can contain one
+        if b"null" in out and _has_nonfinite(obj):
+            return json.dumps(obj)
+        return out.decode()
+
+except ImportError:  # pragma: no cover
+    json_loads = json.loads
+
+    def json_dumps(obj) -> str:
+        return json.dumps(obj)
+
+
+def _has_nonfinite(obj) -> bool:
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_nonfinite(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_nonfinite(v) for v in obj)
+    return False
+
 import peewee
 from peewee import (
     Model,
@@ -20,6 +56,7 @@ from peewee import (
     BooleanField
 )
 from playhouse.postgres_ext import *
+from playhouse.pool import PooledPostgresqlExtDatabase
 
 from aw_core.models import Event
 from aw_core.dirs import get_data_dir
@@ -37,13 +74,39 @@ peewee_logger.setLevel(logging.INFO)
 #   See: http://docs.peewee-orm.com/en/latest/peewee/database.html#run-time-database-configuration
 # Another option would be to use peewee's Proxy.
 #   See: http://docs.peewee-orm.com/en/latest/peewee/database.html#dynamic-db
-_db = PostgresqlExtDatabase(
+# Pooled so that concurrent requests each get their own connection, PeeweeStorage
+# methods return it to the pool when done (see pooled_connection).
+#   See: http://docs.peewee-orm.com/en/latest/peewee/playhouse.html#connection-pool
+_db = PooledPostgresqlExtDatabase(
     'komutracker',  # Required by Peewee.
+    max_connections=16,
+    stale_timeout=300,  # Seconds before an idle connection is recycled
+    timeout=10,  # Seconds to wait for a free connection before MaxConnectionsExceeded
+    autorollback=True,  # Don't leave pooled connections in an aborted transaction
     user='komutracker',  # Will be passed directly to psycopg2.
     password='1q2w#E$R',  # Ditto.
     host='localhost')  # Ditto.
 
 
+def pooled_connection(f):
+    """
+    Runs the decorated method inside `_db.connection_context()`, so that the
+    thread's connection is returned to the pool afterwards.
+
+    If the thread already holds a connection (nested calls, or a caller managing
+    its own connection_context/transaction) it is reused and left open.
+    """
+
+    @functools.wraps(f)
+    def g(*args, **kwargs):
+        if not _db.is_closed():
+            return f(*args, **kwargs)
+        with _db.connection_context():
+            return f(*args, **kwargs)
+
+    return g
+
+
 LATEST_VERSION = 2
 
 
@@ -54,6 +117,11 @@ def chunks(ls, n):
         yield ls[i : i + n]
 
 
+def utc_today() -> datetime:
+    """Start of the current day in UTC, as an aware datetime"""
+    return datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
 def dt_plus_duration(dt, duration):
     # See peewee docs on datemath: https://docs.peewee-orm.com/en/latest/peewee/hacks.html#date-math
     return peewee.fn.strftime(
@@ -66,6 +134,36 @@ def dt_plus_duration_postgres(dt, duration):
     # See peewee docs on datemath: https://docs.peewee-orm.com/en/latest/peewee/hacks.html#date-math
     return SQL(f"{dt} + make_interval(secs => {duration})")
 
+def dt_utc_plus_duration(dt, duration):
+    # timestamptz + interval isn't IMMUTABLE in Postgres (it depends on the session
+    # timezone), so it can't be indexed. Converting to a UTC timestamp first makes
+    # the expression indexable, this must match the events_bucket_tsend index exactly.
+    return peewee.NodeList((dt, SQL("AT TIME ZONE 'UTC'")), parens=True) + duration
+
+def _get_events_sql(starttime: bool, endtime: bool) -> str:
+    """Builds the raw get_events query for one (starttime?, endtime?) shape"""
+    # Trim events that are out of range (as done in aw-server-rust)
+    # TODO: Do the same for the other storage methods
+    ts_start = "events.timestamp"
+    ts_end = "(events.timestamp + events.duration)"
+    where = ["events.bucket_id = %(bucket)s"]
+    if starttime:
+        ts_start = "GREATEST(events.timestamp, %(starttime)s)"
+        # Must match the events_bucket_tsend index, see dt_utc_plus_duration
+        where.append(
+            "((events.timestamp AT TIME ZONE 'UTC') + events.duration) >= %(starttime_utc)s"
+        )
+    if endtime:
+        ts_end = "LEAST(events.timestamp + events.duration, %(endtime)s)"
+        where.append("events.timestamp <= %(endtime)s")
+    duration = f"{ts_end} - {ts_start}" if starttime or endtime else "events.duration"
+    # ORDER BY must use the qualified column, a bare name would pick the trimmed alias
+    return (
+        f"SELECT events.id, {ts_start} AS timestamp, {duration} AS duration, events.datastr "
+        f"FROM events WHERE {' AND '.join(where)} "
+        "ORDER BY events.timestamp DESC LIMIT %(limit)s"
+    )
+
 
 class BaseModel(Model):
     class Meta:
@@ -134,8 +232,8 @@ class EventModel(BaseModel):
             bucket=bucket_key,
             id=event.id,
             timestamp=event.timestamp,
-            duration=f"S {event.duration.total_seconds()}",
-            datastr=json.dumps(event.data),
+            duration=event.duration,
+            datastr=json_dumps(event.data),
         )
 
     def json(self):
@@ -143,7 +241,7 @@ class EventModel(BaseModel):
             "id": self.id,
             "timestamp": self.timestamp,
             "duration": self.duration,
-            "data": json.loads(self.datastr),
+            "data": json_loads(self.datastr),
         }
 
 class ReportModel(BaseModel):
@@ -170,6 +268,15 @@ class ReportModel(BaseModel):
 class PeeweeStorage(AbstractStorage):
     sid = "peewee"
 
+    # get_events is hot enough that building the query with peewee on every call
+    # shows up, so the SQL for each (starttime?, endtime?) shape is generated once
+    _get_events_queries = {
+        (has_start, has_end): _get_events_sql(has_start, has_end)
+        for has_start in (False, True)
+        for has_end in (False, True)
+    }
+
+    @pooled_connection
     def __init__(self, testing: bool = True, filepath: str = None) -> None:
         # data_dir = get_data_dir("aw-server")
 
@@ -185,13 +292,18 @@ class PeeweeStorage(AbstractStorage):
         # self.db.init(filepath)
         logger.info(f"Using database file: {filepath}")
 
-        self.db.connect()
-
         self.bucket_keys: Dict[str, int] = {}
         BucketModel.create_table(safe=True)
         EventModel.create_table(safe=True)
         UserModel.create_table(safe=True)
         ReportModel.create_table(safe=True)
+
+        self.db.execute_sql(
+            "CREATE INDEX IF NOT EXISTS events_bucket_ts_desc ON events (bucket_id, timestamp DESC)"
+        )
+        self.db.execute_sql(
+            "CREATE INDEX IF NOT EXISTS events_bucket_tsend ON events (bucket_id, ((timestamp AT TIME ZONE 'UTC') + duration))"
+        )
         
         migrator = PostgresqlMigrator(self.db)
         if any('last_used_at' == users_column.name for users_column in self.db.get_columns('users')):
@@ -199,15 +311,19 @@ class PeeweeStorage(AbstractStorage):
         else:
             migrate(migrator.add_column('users', 'last_used_at', DateTimeTZField(null=True)))
         # migrate(migrator.drop_column('users', 'last_used_at'))
+        self.db.execute_sql(
+            "CREATE INDEX IF NOT EXISTS users_last_used_at ON users (last_used_at)"
+        )
 
         self.update_bucket_keys()
         self.cached_buckets = None
         self.last_cached_ms = 0
 
     def update_bucket_keys(self) -> None:
-        buckets = BucketModel.select()
+        buckets = BucketModel.select(BucketModel.id, BucketModel.key)
         self.bucket_keys = {bucket.id: bucket.key for bucket in buckets}
 
+    @pooled_connection
     def buckets(self) -> Dict[str, Dict[str, Any]]:
         # if time.time() - self.last_cached_ms < 60000:
         #     print("cached")
@@ -218,6 +334,7 @@ class PeeweeStorage(AbstractStorage):
         # self.last_cached_ms = time.time()
         return buckets
 
+    @pooled_connection
     def create_bucket(
         self,
         bucket_id: str,
@@ -227,7 +344,7 @@ class PeeweeStorage(AbstractStorage):
         created: str,
         name: Optional[str] = None,
     ):
-        BucketModel.create(
+        bucket = BucketModel.create(
             id=bucket_id,
             type=type_id,
             client=client,
@@ -235,8 +352,9 @@ class PeeweeStorage(AbstractStorage):
             created=created,
             name=name,
         )
-        self.update_bucket_keys()
+        self.bucket_keys[bucket_id] = bucket.key
 
+    @pooled_connection
     def delete_bucket(self, bucket_id: str) -> None:
         if bucket_id in self.bucket_keys:
             EventModel.delete().where(
@@ -245,10 +363,11 @@ class PeeweeStorage(AbstractStorage):
             BucketModel.delete().where(
                 BucketModel.key == self.bucket_keys[bucket_id]
             ).execute()
-            self.update_bucket_keys()
+            self.bucket_keys.pop(bucket_id, None)
         else:
             raise Exception("Bucket did not exist, could not delete")
 
+    @pooled_connection
     def get_metadata(self, bucket_id: str):
         if bucket_id in self.bucket_keys:
             return BucketModel.get(
@@ -257,37 +376,73 @@ class PeeweeStorage(AbstractStorage):
         else:
             raise Exception("Bucket did not exist, could not get metadata")
 
+    @pooled_connection
     def insert_one(self, bucket_id: str, event: Event) -> Event:
         e = EventModel.from_event(self.bucket_keys[bucket_id], event)
         e.save()
         event.id = e.id
         return event
 
+    @pooled_connection
     def insert_many(self, bucket_id, events: List[Event]) -> None:
         # NOTE: Events need to be handled differently depending on
         #       if they're upserts or inserts (have id's or not).
+        bucket_key = self.bucket_keys[bucket_id]
 
-        # These events are updates which need to be applied one by one
-        events_updates = [e for e in events if e.id is not None]
-        for e in events_updates:
-            self.insert_one(bucket_id, e)
+        # These events are upserts, applied in batches with ON CONFLICT (id) DO UPDATE.
+        # Keyed by id so that the last of several events with the same id wins,
+        # Postgres refuses to update the same row twice within one statement.
+        events_updates = list(
+            {
+                event.id: {
+                    "id": event.id,
+                    "bucket": bucket_key,
+                    "timestamp": event.timestamp,
+                    "duration": event.duration,
+                    "datastr": json_dumps(event.data),
+                }
+                for event in events
+                if event.id is not None
+            }.values()
+        )
 
         # These events can be inserted with insert_many
         events_dictlist = [
             {
-                "bucket": self.bucket_keys[bucket_id],
+                "bucket": bucket_key,
                 "timestamp": event.timestamp,
-                "duration": f"S {event.duration.total_seconds()}",
-                "datastr": json.dumps(event.data),
+                "duration": event.duration,
+                "datastr": json_dumps(event.data),
             }
             for event in events
             if event.id is None
         ]
 
-        # Chunking into lists of length 100 is needed here due to SQLITE_MAX_COMPOUND_SELECT
-        # and SQLITE_LIMIT_VARIABLE_NUMBER under Windows.
-        # See: https://github.com/coleifer/peewee/issues/948
-        for chunk in chunks(events_dictlist, 100):
+        # Postgres has no SQLITE_LIMIT_VARIABLE_NUMBER equivalent, so chunks can be
+        # much larger than the 100 needed for SQLite (see peewee issue #948)
+        for chunk in chunks(events_updates, 500):
+            EventModel.insert_many(chunk).on_conflict(
+                conflict_target=[EventModel.id],
+                update={
+                    EventModel.timestamp: peewee.EXCLUDED.timestamp,
+                    EventModel.duration: peewee.EXCLUDED.duration,
+                    EventModel.datastr: peewee.EXCLUDED.datastr,
+                },
+                # Never touch an event with the same id in another bucket
+                where=(EventModel.bucket == peewee.EXCLUDED.bucket_id),
+            ).execute()
+        if events_updates:
+            # Rows inserted with an explicit id don't advance the serial sequence,
+            # without this a later insert without an id could reuse one of them.
+            # GREATEST makes sure the sequence is only ever moved forwards.
+            seq = self.db.execute_sql(
+                "SELECT pg_get_serial_sequence('events', 'id')"
+            ).fetchone()[0]
+            self.db.execute_sql(
+                "SELECT setval(%s, GREATEST(%s, last_value)) FROM {}".format(seq),
+                (seq, max(e["id"] for e in events_updates)),
+            )
+        for chunk in chunks(events_dictlist, 500):
             EventModel.insert_many(chunk).execute()
 
     def _get_event(self, bucket_id, event_id) -> Optional[EventModel]:
@@ -309,15 +464,17 @@ class PeeweeStorage(AbstractStorage):
             .get()
         )
 
+    @pooled_connection
     def replace_last(self, bucket_id, event):
         e = self._get_last(bucket_id)
         e.timestamp = event.timestamp
-        e.duration = f"S {event.duration.total_seconds()}"
-        e.datastr = json.dumps(event.data)
+        e.duration = event.duration
+        e.datastr = json_dumps(event.data)
         e.save()
         event.id = e.id
         return event
 
+    @pooled_connection
     def delete(self, bucket_id, event_id):
         return (
             EventModel.delete()
@@ -326,15 +483,17 @@ class PeeweeStorage(AbstractStorage):
             .execute()
         )
 
+    @pooled_connection
     def replace(self, bucket_id, event_id, event):
         e = self._get_event(bucket_id, event_id)
         e.timestamp = event.timestamp
-        e.duration = f"S {event.duration.total_seconds()}"
-        e.datastr = json.dumps(event.data)
+        e.duration = event.duration
+        e.datastr = json_dumps(event.data)
         e.save()
         event.id = e.id
         return event
 
+    @pooled_connection
     def get_event(
         self,
         bucket_id: str,
@@ -346,6 +505,7 @@ class PeeweeStorage(AbstractStorage):
         res = self._get_event(bucket_id, event_id)
         return Event(**EventModel.json(res)) if res else None
 
+    @pooled_connection
     def get_events(
         self,
         bucket_id: str,
@@ -370,48 +530,51 @@ class PeeweeStorage(AbstractStorage):
         """
         if limit == 0:
             return []
-        
-
-        q = (
-            EventModel.select()
-            .where(EventModel.bucket == self.bucket_keys[bucket_id])
-            .order_by(EventModel.timestamp.desc())
-        )
 
-        if limit > 0:
-            q = q.limit(limit)
-
-        q = self._where_range(q, starttime, endtime)
-        res = q.execute()
-        events = [Event(**e) for e in list(map(EventModel.json, res))]
-
-        # Trim events that are out of range (as done in aw-server-rust)
-        # TODO: Do the same for the other storage methods
         if starttime:
             starttime = starttime.astimezone(timezone.utc)
         if endtime:
             endtime = endtime.astimezone(timezone.utc)
-        for e in events:
-            if starttime:
-                if e.timestamp < starttime:
-                    e_end = e.timestamp + e.duration
-                    e.timestamp = starttime
-                    e.duration = e_end - e.timestamp
-            if endtime:
-                if e.timestamp + e.duration > endtime:
-                    e.duration = endtime - e.timestamp
+
+        sql = self._get_events_queries[(bool(starttime), bool(endtime))]
+        params = {
+            "bucket": self.bucket_keys[bucket_id],
+            "starttime": starttime,
+            "starttime_utc": starttime.replace(tzinfo=None) if starttime else None,
+            "endtime": endtime,
+            # LIMIT NULL is the same as no limit
+            "limit": limit if limit > 0 else None,
+        }
+
+        events = []
+        for event_id, timestamp, duration, datastr in self.db.execute_sql(sql, params):
+            events.append(
+                Event(
+                    id=event_id,
+                    timestamp=timestamp,
+                    duration=duration,
+                    data=json_loads(datastr),
+                )
+            )
 
         return events
 
-    def get_last_event(self, bucket_id, day=datetime.now()):
+    @pooled_connection
+    def get_last_event(self, bucket_id, day: Optional[date] = None):
+        # Evaluated per call, a datetime.now() default would be frozen at import time
+        day = day or utc_today()
         event = (
             EventModel.select()
-            .where((EventModel.bucket == self.bucket_keys[bucket_id]) & (peewee.fn.date_trunc('day', EventModel.timestamp) == day))
+            .where(EventModel.bucket == self.bucket_keys[bucket_id])
+            .where(self._where_day(EventModel.timestamp, day))
             .order_by(EventModel.timestamp.desc())
             .limit(1)
         )
-        return event
+        # Executed here, returning the query would run it after the connection
+        # has been returned to the pool
+        return [Event(**EventModel.json(e)) for e in event]
 
+    @pooled_connection
     def get_eventcount(
         self,
         bucket_id: str,
@@ -435,20 +598,22 @@ class PeeweeStorage(AbstractStorage):
             endtime = endtime.astimezone(timezone.utc)
 
         if starttime:
-            # Faster WHERE to speed up slow query below, leads to ~2-3x speedup
-            # We'll assume events aren't >24h
-            q = q.where(starttime - timedelta(hours=24) <= EventModel.timestamp)
-
-            # This can be slow on large databases...
-            # Tried creating various indexes and using SQLite's unlikely() function, but it had no effect
+            # Uses the events_bucket_tsend expression index, compared as a naive UTC timestamp
             q = q.where(
-                starttime <= EventModel.timestamp + EventModel.duration
+                dt_utc_plus_duration(EventModel.timestamp, EventModel.duration)
+                >= starttime.replace(tzinfo=None)
             )
         if endtime:
             q = q.where(EventModel.timestamp <= endtime)
 
         return q
 
+    @staticmethod
+    def _where_day(field, day):
+        # Half-open range instead of date_trunc('day', field) == day, which can't use
+        # the btree index on field (and date_trunc on timestamptz isn't indexable)
+        return (field >= day) & (field < day + timedelta(days=1))
+
     def _get_user_by_email(self, email) -> Optional[UserModel]:
         try:
             return (
@@ -459,41 +624,59 @@ class PeeweeStorage(AbstractStorage):
         except peewee.DoesNotExist:
             return None
 
+    @pooled_connection
     def save_user(self, user_data):
-        UserModel.delete().where(UserModel.email == user_data['email']).execute()
-
         last_used_at = datetime.now(timezone.utc)
-        UserModel.create(
+        UserModel.insert(
             device_id=user_data["device_id"],
             name=user_data["name"],
             email=user_data['email'],
             access_token=user_data["access_token"], 
             refresh_token=user_data["refresh_token"],
             last_used_at=last_used_at
-        )
+        ).on_conflict(
+            conflict_target=[UserModel.email],
+            update={
+                UserModel.device_id: peewee.EXCLUDED.device_id,
+                UserModel.name: peewee.EXCLUDED.name,
+                UserModel.access_token: peewee.EXCLUDED.access_token,
+                UserModel.refresh_token: peewee.EXCLUDED.refresh_token,
+                UserModel.last_used_at: peewee.EXCLUDED.last_used_at,
+            },
+        ).execute()
         user_data["last_used_at"] = last_used_at.isoformat()
         return user_data
 
+    @pooled_connection
     def get_user(self, filter):
         user = self._get_user_by_email(filter["email"])
         if user:
             return self._get_user_by_email(filter["email"]).json()
         return json.dumps({})
     
+    @pooled_connection
     def get_all_users(self):
-        users = UserModel.select()
-        result = []
-        for user in users:
-            result.append(user.json())
-        return result
-
-    def get_use_tracker(self, day=datetime.now().date()):
-        users = UserModel.select().where(peewee.fn.date_trunc('day', UserModel.last_used_at) >= day)
-        result = []
-        for user in users:
-            result.append(user.json())
-        return result
+        return list(UserModel.select().dicts())
+
+    @pooled_connection
+    def get_use_tracker(self, day: Optional[date] = None):
+        day = day or utc_today()
+        # Tokens are left out, they're large and not needed for usage tracking
+        users = (
+            UserModel.select(
+                UserModel.id,
+                UserModel.device_id,
+                UserModel.name,
+                UserModel.email,
+                UserModel.last_used_at,
+            )
+            # Same as date_trunc('day', last_used_at) >= day, but can use an index on last_used_at
+            .where(UserModel.last_used_at >= day)
+            .dicts()
+        )
+        return list(users)
 
+    @pooled_connection
     def save_report(self, report_data):
         ReportModel.create(
             email = report_data["email"],
@@ -504,10 +687,24 @@ class PeeweeStorage(AbstractStorage):
         )
         return report_data
 
-    def get_report(self, email, day=datetime.now()):
+    @pooled_connection
+    def get_report(self, email, day: Optional[date] = None):
+        day = day or utc_today()
         try:
-            report = ReportModel.select().where((ReportModel.email == email) & (peewee.fn.date_trunc('day', ReportModel.date) == day)).get().json()
-            report['active_time'] = report['spent_time'] + report['call_time']
-            return report
+            return (
+                ReportModel.select(
+                    ReportModel.id,
+                    ReportModel.email,
+                    ReportModel.spent_time,
+                    ReportModel.call_time,
+                    (ReportModel.spent_time + ReportModel.call_time).alias("active_time"),
+                    ReportModel.date,
+                    ReportModel.wfh,
+                )
+                .where(ReportModel.email == email)
+                .where(self._where_day(ReportModel.date, day))
+                .dicts()
+                .get()
+            )
         except peewee.DoesNotExist:
             return None
\ No newline at end of file
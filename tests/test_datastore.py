@@ -71,6 +71,135 @@ def test_delete_bucket(datastore):
         datastore.delete_bucket(bid)
 
 
+@pytest.mark.parametrize("datastore", param_datastore_objects(sids=["peewee"]))
+def test_bucket_keys(datastore):
+    """
+    Tests that bucket_keys is kept in sync on create/delete without a reload
+    """
+    from aw_datastore.storages.peewee import BucketModel
+
+    storage = datastore.storage_strategy
+    bid = "test-bucket-keys"
+    datastore.create_bucket(
+        bucket_id=bid, type="test", client="test", hostname="test", name="test"
+    )
+    try:
+        assert storage.bucket_keys[bid] == BucketModel.get(BucketModel.id == bid).key
+    finally:
+        datastore.delete_bucket(bid)
+    assert bid not in storage.bucket_keys
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects(sids=["peewee"]))
+def test_save_user_upsert(datastore):
+    """
+    Tests that saving an existing user updates it in place and keeps its id
+    """
+    from aw_datastore.storages.peewee import UserModel
+
+    email = "test-save-user@example.com"
+    user = {
+        "device_id": "test",
+        "name": "first",
+        "email": email,
+        "access_token": "access",
+        "refresh_token": "refresh",
+    }
+    try:
+        datastore.save_user(dict(user))
+        first = datastore.get_user({"email": email})
+        datastore.save_user(dict(user, name="second"))
+        second = datastore.get_user({"email": email})
+        assert second["id"] == first["id"]
+        assert second["name"] == "second"
+    finally:
+        UserModel.delete().where(UserModel.email == email).execute()
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects())
+def test_delete_bucket_cached(datastore):
+    """
+    Tests that a deleted bucket doesn't linger in cached metadata
+    """
+    bid = "test-delete-cached"
+    datastore.create_bucket(
+        bucket_id=bid, type="test", client="test", hostname="test", name="test"
+    )
+    # Populate any caches before deleting
+    assert bid in datastore.buckets()
+    assert datastore[bid].metadata()["id"] == bid
+    datastore.delete_bucket(bid)
+    assert bid not in datastore.buckets()
+    with pytest.raises(Exception):
+        datastore.storage_strategy.get_metadata(bid)
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects(sids=["mongodb"]))
+def test_buckets_cache_copies(datastore):
+    """
+    Tests that mutating returned metadata doesn't change the cached metadata
+    """
+    bid = "test-cache-copies"
+    datastore.create_bucket(
+        bucket_id=bid, type="test", client="test", hostname="test", name="test"
+    )
+    try:
+        datastore.buckets()[bid]["name"] = "changed"
+        datastore.storage_strategy.get_metadata(bid)["type"] = "changed"
+        metadata = datastore.storage_strategy.get_metadata(bid)
+        assert metadata["name"] == "test"
+        assert metadata["type"] == "test"
+    finally:
+        datastore.delete_bucket(bid)
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects(sids=["mongodb"]))
+def test_buckets_cache_ttl(datastore):
+    """
+    Tests that the cached bucket list is reloaded once it has expired
+    """
+    storage = datastore.storage_strategy
+    bid = "test-cache-ttl"
+    storage.buckets()
+    # Simulates a bucket created by another process, bypassing this storage's cache
+    storage.buckets_coll.insert_one(
+        {"id": bid, "name": bid, "type": "test", "client": "test", "hostname": "test"}
+    )
+    try:
+        assert bid not in storage.buckets()
+        # Same as BUCKETS_TTL_SECONDS having passed since the last reload
+        storage._cache_deadline = 0.0
+        assert bid in storage.buckets()
+    finally:
+        storage.buckets_coll.delete_one({"id": bid})
+
+
+@pytest.mark.parametrize("datastore", param_datastore_objects(sids=["peewee"]))
+def test_report_default_day(datastore):
+    """
+    Tests that get_report without a day finds the report saved today
+    """
+    from aw_datastore.storages.peewee import ReportModel
+
+    storage = datastore.storage_strategy
+    email = "test-report-today@example.com"
+    try:
+        storage.save_report(
+            {
+                "email": email,
+                "spent_time": 1.0,
+                "call_time": 2.0,
+                "date": datetime.now(timezone.utc),
+                "wfh": False,
+            }
+        )
+        report = storage.get_report(email)
+        assert report is not None
+        assert report["active_time"] == 3.0
+    finally:
+        ReportModel.delete().where(ReportModel.email == email).execute()
+
+
 @pytest.mark.parametrize("datastore", param_datastore_objects())
 def test_nonexistant_bucket(datastore):
     """
@@ -39,10 +39,12 @@ class TempTestBucket:
 _storage_methods = get_storage_methods()
 
 
-def param_datastore_objects():
+def param_datastore_objects(sids=None):
+    """Datastores for every storage method, or only those listed in sids"""
     return [
         Datastore(storage_strategy=strategy, testing=True)
         for name, strategy in _storage_methods.items()
+        if sids is None or name in sids
     ]
 
 